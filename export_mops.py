@@ -1,6 +1,7 @@
 ﻿import bpy
 import os
 import operator
+import hashlib
 from  mathutils import *
 import math
 from struct import pack
@@ -18,6 +19,24 @@ SIZE_INFLUENCE = 12
 SIZE_ANIMATION = 76
 SIZE_ANIMBONE = 68
 SIZE_ANIMKEY = 32
+SIZE_INDEX = 4
+SIZE_BOUNDS = 40
+SIZE_MATERIALBOUNDS = 52
+SIZE_BVHNODE = 32
+SIZE_INSTANCEINFO = 108
+SIZE_MESHLET = 52
+SIZE_MESHLETTRIANGLE = 3
+SIZE_MORPH = 72
+SIZE_MORPHDELTA = 16
+SIZE_MORPHANIM = 76
+SIZE_MORPHTRACK = 68
+SIZE_MORPHKEY = 8
+
+BVH_LEAF_SIZE = 4
+MESHLET_MAX_VERTICES = 64
+MESHLET_MAX_TRIANGLES = 124
+MORPH_DELTA_THRESHOLD = 0.0001
+MORPH_WEIGHT_THRESHOLD = 0.001
 
 
 class ObjectMap( object ):
@@ -50,6 +69,21 @@ class ObjectInfo( object ):
         return pack( '<64s', str.encode( self.name ) )
     
 
+class InstanceInfo( ObjectInfo ):
+    
+    def __init__( self, name ):
+        ObjectInfo.__init__( self, name )
+        self.geometry_index = 0
+        self.position = Vector()
+        self.orientation = Quat()
+        self.scale = Vector( 1.0, 1.0, 1.0 )
+        
+    def dump( self ):
+        data = pack( '<64sl', str.encode( self.name ), self.geometry_index )
+        data += self.position.dump() + self.orientation.dump() + self.scale.dump()
+        return data
+    
+
 class ARGB( object ):
     
     def __init__( self, a = 255, r = 0, g = 0, b = 0 ):
@@ -131,6 +165,15 @@ class Vector( object ):
     def __sub__( self, other ):
         return Vector( self.x - other.x, self.y - other.y, self.z - other.z )
 
+    def __add__( self, other ):
+        return Vector( self.x + other.x, self.y + other.y, self.z + other.z )
+
+    def __mul__( self, scalar ):
+        return Vector( self.x * scalar, self.y * scalar, self.z * scalar )
+
+    def length( self ):
+        return math.sqrt( self.dot( self ) )
+
 
 class Point( object ):
     
@@ -271,6 +314,154 @@ class AKey( object ):
         return self.position.dump() + self.orientation.dump() + pack( '<l', self.time )
 
 
+class Index( object ):
+
+    def __init__( self, value = 0 ):
+        self.value = value
+
+    def dump( self ):
+        return pack( '<l', self.value )
+
+
+class Bounds( object ):
+
+    def __init__( self ):
+        self.minimum = Vector()
+        self.maximum = Vector()
+        self.center = Vector()
+        self.radius = 0.0
+
+    def dump( self ):
+        return self.minimum.dump() + self.maximum.dump() + self.center.dump() + pack( '<f', self.radius )
+
+
+class MaterialBounds( object ):
+
+    def __init__( self ):
+        self.material_index = 0
+        self.first_face = 0
+        self.face_count = 0
+        self.bounds = Bounds()
+
+    def dump( self ):
+        return pack( '<3l', self.material_index, self.first_face, self.face_count ) + self.bounds.dump()
+
+
+class BVHNode( object ):
+
+    # Leaf: first/count address BVHTRI. Inner node (count == 0): left child
+    # is the next node, first is the index of the right child.
+    def __init__( self ):
+        self.minimum = Vector()
+        self.maximum = Vector()
+        self.first = 0
+        self.count = 0
+
+    def dump( self ):
+        return self.minimum.dump() + self.maximum.dump() + pack( '<2l', self.first, self.count )
+
+
+class Meshlet( object ):
+    
+    # Backface cull test for the whole cluster:
+    # dot( center - camera, cone_axis ) >= cone_cutoff * length( center - camera ) + radius
+    # cone_cutoff == 1.0 means the cluster can not be backface culled.
+    def __init__( self ):
+        self.material_index = 0
+        self.vertex_offset = 0
+        self.vertex_count = 0
+        self.triangle_offset = 0
+        self.triangle_count = 0
+        self.center = Vector()
+        self.radius = 0.0
+        self.cone_axis = Vector()
+        self.cone_cutoff = 1.0
+        
+    def dump( self ):
+        data = pack( '<5l', self.material_index, self.vertex_offset, self.vertex_count, self.triangle_offset, self.triangle_count )
+        data += self.center.dump() + pack( '<f', self.radius )
+        data += self.cone_axis.dump() + pack( '<f', self.cone_cutoff )
+        return data
+
+
+class MeshletTriangle( object ):
+    
+    def __init__( self, index1 = 0, index2 = 0, index3 = 0 ):
+        self.index1 = index1
+        self.index2 = index2
+        self.index3 = index3
+        
+    def dump( self ):
+        return pack( '<3B', self.index1, self.index2, self.index3 )
+
+
+class Morph( object ):
+    
+    def __init__( self ):
+        self.name = ""
+        self.first_delta = 0
+        self.delta_count = 0
+        
+    def dump( self ):
+        return pack( '<64s2l', str.encode( self.name ), self.first_delta, self.delta_count )
+
+
+class MorphDelta( object ):
+    
+    def __init__( self ):
+        self.point_index = 0
+        self.delta = Vector()
+        
+    def dump( self ):
+        return pack( '<l', self.point_index ) + self.delta.dump()
+
+
+class MorphAnimation( object ):
+    
+    def __init__( self ):
+        self.name = ""
+        self.morph_count = 0
+        self.key_count = 0
+        self.track_time = 0
+    
+    def dump( self ):
+        return pack( '<64s3l', str.encode( self.name ), self.morph_count, self.key_count, self.track_time )
+
+
+class MorphTrack( object ):
+    
+    def __init__( self ):
+        self.name = ""
+        self.key_count = 0
+    
+    def dump( self ):
+        return pack( '<64sl', str.encode( self.name ), self.key_count )
+
+
+class MorphKey( object ):
+    
+    def __init__( self ):
+        self.weight = 0.0
+        self.time = 0
+        
+    def dump( self ):
+        return pack( '<fl', self.weight, self.time )
+
+
+class Geometry( object ):
+    
+    # ( first, count ) for every MOPSFile.geometry_chunks() entry. Indices
+    # stored inside those chunks stay local to the geometry block.
+    def __init__( self ):
+        self.ranges = []
+        
+    def dump( self ):
+        data = b''
+        for first, count in self.ranges:
+            data += pack( '<2l', first, count )
+        return data
+
+
 class ChunkHeader( object ):
     
     def __init__( self, name, type_size ):
@@ -312,6 +503,20 @@ class MOPSFile( object ):
         self.animations = Chunk( "ANIMAT", SIZE_ANIMATION )
         self.anim_bones = Chunk( "ANIMBONE", SIZE_ANIMBONE )
         self.anim_keys = Chunk( "ANIMKEY", SIZE_ANIMKEY )
+        self.bounds = Chunk( "BOUNDS", SIZE_BOUNDS )
+        self.material_bounds = Chunk( "MATBOUNDS", SIZE_MATERIALBOUNDS )
+        self.bone_bounds = Chunk( "BONEBOUNDS", SIZE_BOUNDS )
+        self.bvh_nodes = Chunk( "BVHNODE", SIZE_BVHNODE )
+        self.bvh_triangles = Chunk( "BVHTRI", SIZE_INDEX )
+        self.meshlets = Chunk( "MESHLET", SIZE_MESHLET )
+        self.meshlet_vertices = Chunk( "MESHLETVERT", SIZE_INDEX )
+        self.meshlet_triangles = Chunk( "MESHLETTRI", SIZE_MESHLETTRIANGLE )
+        self.morphs = Chunk( "MORPH", SIZE_MORPH )
+        self.morph_deltas = Chunk( "MORPHDELTA", SIZE_MORPHDELTA )
+        self.morph_animations = Chunk( "MORPHANIM", SIZE_MORPHANIM )
+        self.morph_tracks = Chunk( "MORPHTRACK", SIZE_MORPHTRACK )
+        self.morph_keys = Chunk( "MORPHKEY", SIZE_MORPHKEY )
+        self.geometries = Chunk( "GEOM", SIZE_INDEX * 2 * len( self.geometry_chunks() ) )
         
     def add_info( self, i ):
         self.info.data.append( i )
@@ -343,6 +548,72 @@ class MOPSFile( object ):
     def add_anim_key( self, k ):
         self.anim_keys.data.append( k )
         
+    def add_bounds( self, b ):
+        self.bounds.data.append( b )
+        
+    def add_material_bounds( self, mb ):
+        self.material_bounds.data.append( mb )
+        
+    def add_bone_bounds( self, b ):
+        self.bone_bounds.data.append( b )
+        
+    def add_bvh_node( self, n ):
+        self.bvh_nodes.data.append( n )
+        
+    def add_bvh_triangle( self, t ):
+        self.bvh_triangles.data.append( t )
+        
+    def add_meshlet( self, m ):
+        self.meshlets.data.append( m )
+        
+    def add_meshlet_vertex( self, v ):
+        self.meshlet_vertices.data.append( v )
+        
+    def add_meshlet_triangle( self, t ):
+        self.meshlet_triangles.data.append( t )
+        
+    def add_morph( self, m ):
+        self.morphs.data.append( m )
+        
+    def add_morph_delta( self, d ):
+        self.morph_deltas.data.append( d )
+        
+    def add_morph_animation( self, an ):
+        self.morph_animations.data.append( an )
+        
+    def add_morph_track( self, t ):
+        self.morph_tracks.data.append( t )
+        
+    def add_morph_key( self, k ):
+        self.morph_keys.data.append( k )
+        
+    def add_geometry( self, g ):
+        self.geometries.data.append( g )
+        
+    def optional_chunks( self ):
+        return [ self.bounds, self.material_bounds, self.bone_bounds, self.bvh_nodes, self.bvh_triangles,
+                 self.meshlets, self.meshlet_vertices, self.meshlet_triangles,
+                 self.morphs, self.morph_deltas, self.morph_animations, self.morph_tracks, self.morph_keys, self.geometries ]
+    
+    def geometry_chunks( self ):
+        return [ self.points, self.vertices, self.faces, self.materials, self.bounds, self.material_bounds, self.bvh_nodes, self.bvh_triangles,
+                 self.meshlets, self.meshlet_vertices, self.meshlet_triangles, self.morphs, self.morph_deltas ]
+    
+    def geometry_hash( self ):
+        digest = hashlib.sha1()
+        for chunk in self.geometry_chunks():
+            for item in chunk.data:
+                digest.update( item.dump() )
+        return digest.hexdigest()
+    
+    def append_geometry( self, other ):
+        geometry = Geometry()
+        for chunk, other_chunk in zip( self.geometry_chunks(), other.geometry_chunks() ):
+            geometry.ranges.append( ( len( chunk.data ), len( other_chunk.data ) ) )
+            chunk.data.extend( other_chunk.data )
+        self.add_geometry( geometry )
+        return len( self.geometries.data ) - 1
+        
     def update_headers( self ):
         self.info.update_header()
         self.points.update_header()
@@ -354,6 +625,8 @@ class MOPSFile( object ):
         self.animations.update_header()
         self.anim_bones.update_header()
         self.anim_keys.update_header()
+        for chunk in self.optional_chunks():
+            chunk.update_header()
     
     def dump( self ):
         self.update_headers()
@@ -368,6 +641,9 @@ class MOPSFile( object ):
         data += self.animations.dump()
         data += self.anim_bones.dump()
         data += self.anim_keys.dump()
+        for chunk in self.optional_chunks():
+            if len( chunk.data ):
+                data += chunk.dump()
         return data
 
     def print( self ):
@@ -382,14 +658,15 @@ class MOPSFile( object ):
         print( "{:<15} {}".format( "Animations", len( self.animations.data ) ) )
         print( "{:<15} {}".format( "Animation bones", len( self.anim_bones.data ) ) )
         print( "{:<15} {}".format( "Animation keys", len( self.anim_keys.data ) ) )
+        for chunk in self.optional_chunks():
+            if len( chunk.data ):
+                print( "{:<15} {}".format( chunk.header.chunk_id.decode(), len( chunk.data ) ) )
         print()
 
 
-def parse_mesh_and_armature( mesh, armature, mops ):
+def parse_mesh( mesh, mops, matrix, bounds = False, meshlets = False, shape_keys = None ):
     
     print( "Mesh parsing..." )
-    
-    scene = bpy.context.scene
         
     print( "Materials..." )
     print( "{:<20}{}".format( "Materials count", len( mesh.material_slots ) ) )
@@ -433,6 +710,7 @@ def parse_mesh_and_armature( mesh, armature, mops ):
     print ("Parsing Faces..." )
         
     linked_points = {}
+    vertex_points = {}
     points = ObjectMap()
     vertices = ObjectMap()
     triangles = []
@@ -462,13 +740,17 @@ def parse_mesh_and_armature( mesh, armature, mops ):
         for i in range( 3 ):
             vertex_index = face.vertices[ i ]
             vertex_m = mesh.data.vertices[ vertex_index ]
-            vertex_position = mesh.matrix_local * vertex_m.co
+            vertex_position = matrix * vertex_m.co
             
             point = Point()
             point.point.x = vertex_position.x
             point.point.y = vertex_position.y
             point.point.z = vertex_position.z
-            point_index = points.get( point )
+            
+            # Vertices are only welded if they also move together under every shape key.
+            offsets = shape_keys[ 1 ][ vertex_index ] if shape_keys is not None else None
+            point_index = points.get( ( point, offsets ) )
+            vertex_points[ vertex_index ] = point_index
             
             uv = []
             if has_uv and len( face_uv.uv ) == 3:
@@ -507,7 +789,7 @@ def parse_mesh_and_armature( mesh, armature, mops ):
     triangles.sort()
     print( "Parsing faces is completed.".format( per ) )
     
-    for point in points.items():
+    for point, offsets in points.items():
         mops.add_point( point )
     
     for vertex in vertices.items():
@@ -516,6 +798,27 @@ def parse_mesh_and_armature( mesh, armature, mops ):
     for triangle in triangles:
         mops.add_face( triangle )
     
+    if bounds:
+        print( "Building bounds..." )
+        build_bounds( mops )
+        build_bvh( mops )
+    
+    if meshlets:
+        print( "Building meshlets..." )
+        build_meshlets( mops )
+    
+    if shape_keys is not None:
+        add_morphs( mops, shape_keys, vertex_points )
+        
+    return linked_points
+
+
+def parse_mesh_and_armature( mesh, armature, mops, bounds = False, meshlets = False, shape_keys = None ):
+    
+    scene = bpy.context.scene
+    
+    linked_points = parse_mesh( mesh, mops, mesh.matrix_local, bounds, meshlets, shape_keys )
+    
     print( "Parsing Armature..." )
     
     vertex_groups = {}
@@ -555,7 +858,7 @@ def parse_mesh_and_armature( mesh, armature, mops ):
         
     bones_list = []
     
-    parse_bone( root_bones[ 0 ], bones_list, vertex_groups, mops )
+    parse_bone( root_bones[ 0 ], bones_list, vertex_groups, mops, bounds )
 
     print( "Parse Animations..." )
     
@@ -565,6 +868,9 @@ def parse_mesh_and_armature( mesh, armature, mops ):
     
     for action in bpy.data.actions:
         
+        if action.id_root == 'KEY':
+            continue
+        
         if not len( action.fcurves ):
             print( "Has no keys..." )
             continue
@@ -631,7 +937,7 @@ def parse_mesh_and_armature( mesh, armature, mops ):
     scene.update()
         
 
-def parse_bone( bone, bones_list, vertex_groups, mops ):
+def parse_bone( bone, bones_list, vertex_groups, mops, bounds = False ):
     bone_index = len( bones_list )
     
     b = Bone()
@@ -665,6 +971,13 @@ def parse_bone( bone, bones_list, vertex_groups, mops ):
             inf.vertex_index = item[ 0 ]
             inf.weight = item[ 1 ]
             mops.add_influence( inf )
+    
+    if bounds:
+        bone_points = []
+        for item in vertex_groups.get( bone.name, [] ):
+            if item[ 1 ] != 0.0:
+                bone_points.append( face_point( mops, item[ 0 ] ) )
+        mops.add_bone_bounds( compute_bounds( bone_points ) )
             
     bones_list.append( b )
     
@@ -672,18 +985,433 @@ def parse_bone( bone, bones_list, vertex_groups, mops ):
     print( "{} done ({} vertices binded).".format( b.name, b.vertex_count) )
     
     for children_bone in bone.children:
-        parse_bone( children_bone, bones_list, vertex_groups, mops )
+        parse_bone( children_bone, bones_list, vertex_groups, mops, bounds )
+
+
+def face_point( mops, vertex_index ):
+    return mops.points.data[ mops.vertices.data[ vertex_index ].point_index ].point
+
+
+def compute_bounds( vectors ):
+    bounds = Bounds()
+    if not len( vectors ):
+        return bounds
+    
+    bounds.minimum = Vector( vectors[ 0 ].x, vectors[ 0 ].y, vectors[ 0 ].z )
+    bounds.maximum = Vector( vectors[ 0 ].x, vectors[ 0 ].y, vectors[ 0 ].z )
+    for v in vectors:
+        bounds.minimum.x = min( bounds.minimum.x, v.x )
+        bounds.minimum.y = min( bounds.minimum.y, v.y )
+        bounds.minimum.z = min( bounds.minimum.z, v.z )
+        bounds.maximum.x = max( bounds.maximum.x, v.x )
+        bounds.maximum.y = max( bounds.maximum.y, v.y )
+        bounds.maximum.z = max( bounds.maximum.z, v.z )
+    
+    bounds.center = ( bounds.minimum + bounds.maximum ) * 0.5
+    bounds.radius = max( ( v - bounds.center ).length() for v in vectors )
+    return bounds
+
+
+def build_bounds( mops ):
+    mops.add_bounds( compute_bounds( [ p.point for p in mops.points.data ] ) )
+    
+    # One entry per material slot, so MATBOUNDS can be indexed like MATT.
+    ranges = {}
+    for face_index, triangle in enumerate( mops.faces.data ):
+        if triangle.material_index in ranges:
+            ranges[ triangle.material_index ][ 1 ] += 1
+        else:
+            ranges[ triangle.material_index ] = [ face_index, 1 ]
     
+    for material_index in range( len( mops.materials.data ) ):
+        material_bounds = MaterialBounds()
+        material_bounds.material_index = material_index
+        if material_index in ranges:
+            material_bounds.first_face, material_bounds.face_count = ranges[ material_index ]
+        
+        vectors = []
+        for triangle in mops.faces.data[ material_bounds.first_face : material_bounds.first_face + material_bounds.face_count ]:
+            vectors.append( face_point( mops, triangle.index1 ) )
+            vectors.append( face_point( mops, triangle.index2 ) )
+            vectors.append( face_point( mops, triangle.index3 ) )
+        material_bounds.bounds = compute_bounds( vectors )
+        mops.add_material_bounds( material_bounds )
+        
+    print( "Mesh bounds {} - {}, radius {:.3f}".format( mops.bounds.data[ 0 ].minimum, mops.bounds.data[ 0 ].maximum, mops.bounds.data[ 0 ].radius ) )
+
+
+def build_bvh( mops ):
+    if not len( mops.faces.data ):
+        return
+    
+    boxes = []
+    for triangle in mops.faces.data:
+        corners = [ face_point( mops, triangle.index1 ), face_point( mops, triangle.index2 ), face_point( mops, triangle.index3 ) ]
+        minimum = [ min( c.x for c in corners ), min( c.y for c in corners ), min( c.z for c in corners ) ]
+        maximum = [ max( c.x for c in corners ), max( c.y for c in corners ), max( c.z for c in corners ) ]
+        centroid = [ ( minimum[ i ] + maximum[ i ] ) * 0.5 for i in range( 3 ) ]
+        boxes.append( ( minimum, maximum, centroid ) )
+    
+    build_bvh_node( list( range( len( boxes ) ) ), boxes, mops )
+    print( "BVH nodes {}".format( len( mops.bvh_nodes.data ) ) )
+
+
+def build_bvh_node( face_indices, boxes, mops ):
+    node = BVHNode()
+    mops.add_bvh_node( node )
+    
+    minimum = [ min( boxes[ f ][ 0 ][ i ] for f in face_indices ) for i in range( 3 ) ]
+    maximum = [ max( boxes[ f ][ 1 ][ i ] for f in face_indices ) for i in range( 3 ) ]
+    node.minimum = Vector( *minimum )
+    node.maximum = Vector( *maximum )
+    
+    if len( face_indices ) <= BVH_LEAF_SIZE:
+        node.first = len( mops.bvh_triangles.data )
+        node.count = len( face_indices )
+        for f in face_indices:
+            mops.add_bvh_triangle( Index( f ) )
+        return
+    
+    # Median split along the longest axis of the centroids.
+    centroid_min = [ min( boxes[ f ][ 2 ][ i ] for f in face_indices ) for i in range( 3 ) ]
+    centroid_max = [ max( boxes[ f ][ 2 ][ i ] for f in face_indices ) for i in range( 3 ) ]
+    extent = [ centroid_max[ i ] - centroid_min[ i ] for i in range( 3 ) ]
+    axis = extent.index( max( extent ) )
+    
+    face_indices.sort( key = lambda f: boxes[ f ][ 2 ][ axis ] )
+    middle = len( face_indices ) // 2
+    
+    build_bvh_node( face_indices[ : middle ], boxes, mops )
+    node.first = len( mops.bvh_nodes.data )
+    build_bvh_node( face_indices[ middle : ], boxes, mops )
+    
+
+def build_meshlets( mops ):
+    first_face = 0
+    while first_face < len( mops.faces.data ):
+        material_index = mops.faces.data[ first_face ].material_index
+        end_face = first_face
+        while end_face < len( mops.faces.data ) and mops.faces.data[ end_face ].material_index == material_index:
+            end_face += 1
+        build_material_meshlets( mops, material_index, first_face, end_face )
+        first_face = end_face
+    
+    print( "Meshlets {}".format( len( mops.meshlets.data ) ) )
+
+
+def build_material_meshlets( mops, material_index, first_face, end_face ):
+    adjacency = {}
+    centroids = {}
+    for face_index in range( first_face, end_face ):
+        triangle = mops.faces.data[ face_index ]
+        for w in set( ( triangle.index1, triangle.index2, triangle.index3 ) ):
+            adjacency.setdefault( w, [] ).append( face_index )
+        centroid = face_point( mops, triangle.index1 ) + face_point( mops, triangle.index2 ) + face_point( mops, triangle.index3 )
+        centroids[ face_index ] = centroid * ( 1.0 / 3.0 )
+    
+    remaining = set( range( first_face, end_face ) )
+    candidates = set()
+    local_vertices = ObjectMap()
+    local_triangles = []
+    center = Vector()
+    center_sum = Vector()
+    
+    while len( remaining ):
+        
+        # Grow the cluster by the neighbour sharing most vertices with it,
+        # the closest one to the cluster centre on ties.
+        best = None
+        if len( local_triangles ) < MESHLET_MAX_TRIANGLES:
+            for face_index in candidates:
+                triangle = mops.faces.data[ face_index ]
+                wedges = set( ( triangle.index1, triangle.index2, triangle.index3 ) )
+                new_vertices = len( [ w for w in wedges if w not in local_vertices.dict ] )
+                if local_vertices.index + new_vertices > MESHLET_MAX_VERTICES:
+                    continue
+                score = ( new_vertices, ( centroids[ face_index ] - center ).length(), face_index )
+                if best is None or score < best:
+                    best = score
+        
+        if best is not None:
+            face_index = best[ 2 ]
+        else:
+            if len( local_triangles ):
+                add_meshlet( mops, material_index, local_vertices, local_triangles )
+                local_vertices = ObjectMap()
+                local_triangles = []
+                center_sum = Vector()
+            
+            # Seed next to the finished cluster, or anywhere if it has no free border.
+            if len( candidates ):
+                face_index = min( candidates, key = lambda f: ( ( centroids[ f ] - center ).length(), f ) )
+            else:
+                face_index = min( remaining )
+            candidates = set()
+        
+        triangle = mops.faces.data[ face_index ]
+        wedges = ( triangle.index1, triangle.index2, triangle.index3 )
+        local_triangles.append( MeshletTriangle( *[ local_vertices.get( w ) for w in wedges ] ) )
+        remaining.discard( face_index )
+        candidates.discard( face_index )
+        
+        center_sum = center_sum + centroids[ face_index ]
+        center = center_sum * ( 1.0 / len( local_triangles ) )
+        
+        for w in wedges:
+            for neighbour in adjacency[ w ]:
+                if neighbour in remaining:
+                    candidates.add( neighbour )
+    
+    if len( local_triangles ):
+        add_meshlet( mops, material_index, local_vertices, local_triangles )
+
+
+def add_meshlet( mops, material_index, local_vertices, local_triangles ):
+    meshlet = Meshlet()
+    meshlet.material_index = material_index
+    meshlet.vertex_offset = len( mops.meshlet_vertices.data )
+    meshlet.vertex_count = local_vertices.index
+    meshlet.triangle_offset = len( mops.meshlet_triangles.data )
+    meshlet.triangle_count = len( local_triangles )
+    
+    vertex_indices = list( local_vertices.items() )
+    for vertex_index in vertex_indices:
+        mops.add_meshlet_vertex( Index( vertex_index ) )
+    for triangle in local_triangles:
+        mops.add_meshlet_triangle( triangle )
+    
+    positions = [ face_point( mops, vertex_index ) for vertex_index in vertex_indices ]
+    bounds = compute_bounds( positions )
+    meshlet.center = bounds.center
+    meshlet.radius = bounds.radius
+    
+    # Front face normal in Blender space, matching the winding chosen in parse_mesh.
+    normals = []
+    for triangle in local_triangles:
+        p0 = positions[ triangle.index1 ]
+        normal = ( positions[ triangle.index3 ] - p0 ).cross( positions[ triangle.index2 ] - p0 )
+        length = normal.length()
+        if length > 0.0:
+            normals.append( normal * ( 1.0 / length ) )
+    
+    axis = Vector()
+    for normal in normals:
+        axis = axis + normal
+    length = axis.length()
+
+    if length > 0.0:
+        axis = axis * ( 1.0 / length )
+        min_dot = min( min( axis.dot( normal ) for normal in normals ), 1.0 )
+        if min_dot > 0.1:
+            meshlet.cone_axis = axis
+            meshlet.cone_cutoff = math.sqrt( 1.0 - min_dot * min_dot )
+
+    mops.add_meshlet( meshlet )
+
+
+def read_shape_keys( obj, mesh, matrix ):
+    key = obj.data.shape_keys
+    if key is None:
+        return None
+    
+    print( "Parsing Shape keys..." )
+    
+    if len( obj.data.vertices ) != len( mesh.data.vertices ):
+        print( "Shape keys skipped: modifiers changed the vertex count" )
+        return None
+    
+    rotation = matrix.to_3x3()
+    names = []
+    key_offsets = []
+    
+    for block in key.key_blocks:
+        if block == key.reference_key:
+            continue
+        
+        relative_key = block.relative_key if key.use_relative else key.reference_key
+        
+        block_offsets = []
+        for vertex_index in range( len( mesh.data.vertices ) ):
+            delta = rotation * ( block.data[ vertex_index ].co - relative_key.data[ vertex_index ].co )
+            if delta.length < MORPH_DELTA_THRESHOLD:
+                block_offsets.append( None )
+            else:
+                block_offsets.append( ( delta.x, delta.y, delta.z ) )
+        
+        names.append( block.name )
+        key_offsets.append( block_offsets )
+    
+    # Per vertex, its offset under every shape key.
+    offsets = list( zip( *key_offsets ) ) if len( key_offsets ) else [ () ] * len( mesh.data.vertices )
+    return ( names, offsets )
+
+
+def add_morphs( mops, shape_keys, vertex_points ):
+    names, offsets = shape_keys
+    
+    for key_index, name in enumerate( names ):
+        deltas = {}
+        for vertex_index, point_index in vertex_points.items():
+            if offsets[ vertex_index ][ key_index ] is not None:
+                deltas[ point_index ] = offsets[ vertex_index ][ key_index ]
+        
+        morph = Morph()
+        morph.name = name
+        morph.first_delta = len( mops.morph_deltas.data )
+        morph.delta_count = len( deltas )
+        
+        for point_index in sorted( deltas ):
+            morph_delta = MorphDelta()
+            morph_delta.point_index = point_index
+            ( morph_delta.delta.x, morph_delta.delta.y, morph_delta.delta.z ) = deltas[ point_index ]
+            mops.add_morph_delta( morph_delta )
+        
+        mops.add_morph( morph )
+        print( "{} done ({} of {} points moved).".format( morph.name, morph.delta_count, len( mops.points.data ) ) )
+
+
+def parse_morph_animations( obj, armature, mops ):
+    key = obj.data.shape_keys
+    if key is None or not len( mops.morphs.data ):
+        return
+    
+    print( "Parse Morph animations..." )
+    
+    scene = bpy.context.scene
+    restore_frame = scene.frame_current
+    fps = scene.render.fps
+    
+    morph_paths = {}
+    for morph in mops.morphs.data:
+        morph_paths[ 'key_blocks["{}"].value'.format( morph.name ) ] = morph.name
+    
+    created_animation_data = key.animation_data is None
+    if created_animation_data:
+        key.animation_data_create()
+    restore_key_action = key.animation_data.action
+    
+    # Driven shape keys follow the armature, so they are baked from its actions.
+    driven = [ morph_paths[ d.data_path ] for d in key.animation_data.drivers if d.data_path in morph_paths ]
+    
+    armature_animated = armature is not None and armature.animation_data is not None
+    if armature_animated:
+        restore_armature_action = armature.animation_data.action
+        armature_bones = set( bone.name for bone in armature.pose.bones )
+    
+    # Weights of the driven keys with the armature in its rest pose.
+    rest_weights = {}
+    if armature_animated and len( driven ):
+        restore_pose_position = armature.data.pose_position
+        armature.data.pose_position = 'REST'
+        scene.update()
+        for name in driven:
+            rest_weights[ name ] = key.key_blocks[ name ].value
+        armature.data.pose_position = restore_pose_position
+        scene.update()
+    
+    for action in bpy.data.actions:
+        
+        if action.id_root == 'KEY':
+            names = [ morph_paths[ c.data_path ] for c in action.fcurves if c.data_path in morph_paths ]
+            names = [ name for name in names if name not in driven ]
+            if not len( names ):
+                continue
+            key.animation_data.action = action
+        elif armature_animated and len( driven ) and any( gr.name in armature_bones for gr in action.groups ):
+            names = driven
+            armature.animation_data.action = action
+        else:
+            continue
+        scene.update()
+        
+        start_frame, end_frame = action.frame_range
+        frame_range = range( int( start_frame ), int( end_frame ) + 1 )
+        frame_count = len( frame_range )
+        
+        morph_keys = {}
+        for i in frame_range:
+            
+            scene.frame_set( i )
+            
+            for name in names:
+                morph_key = MorphKey()
+                morph_key.time = int( 1000.0 * i / fps )
+                morph_key.weight = key.key_blocks[ name ].value
+                
+                if name in morph_keys:
+                    morph_keys[ name ].append( morph_key )
+                else:
+                    morph_keys[ name ] = [ morph_key ]
+        
+        # Armature actions that never move a driver input get no driven tracks.
+        if action.id_root != 'KEY':
+            names = [ name for name in names if any( abs( k.weight - rest_weights[ name ] ) >= MORPH_WEIGHT_THRESHOLD for k in morph_keys[ name ] ) ]
+            if not len( names ):
+                continue
+        
+        for name in names:
+            track = MorphTrack()
+            track.name = name
+            track.key_count = frame_count
+            mops.add_morph_track( track )
+            for morph_key in morph_keys[ name ]:
+                mops.add_morph_key( morph_key )
+        
+        anim = MorphAnimation()
+        anim.name = action.name
+        anim.morph_count = len( names )
+        anim.key_count = frame_count * anim.morph_count
+        anim.track_time = int( 1000.0 * frame_count / fps )
+        print( "{}({})(m{})".format( action.name, anim.track_time, anim.morph_count ) )
+        mops.add_morph_animation( anim )
+    
+    key.animation_data.action = restore_key_action
+    if created_animation_data:
+        key.animation_data_clear()
+    if armature_animated:
+        armature.animation_data.action = restore_armature_action
+    scene.frame_set( restore_frame )
+    scene.update()
+
+
+def mute_shape_keys( obj ):
+    key = obj.data.shape_keys
+    if key is None:
+        return None
+    
+    # The exported base mesh must not include the current shape key mix.
+    # A pinned shape key ignores mute, so unpin it as well.
+    state = ( obj.show_only_shape_key, [ block.mute for block in key.key_blocks ] )
+    obj.show_only_shape_key = False
+    for block in key.key_blocks:
+        block.mute = True
+    return state
+
+
+def unmute_shape_keys( obj, state ):
+    if state is None:
+        return
+    
+    show_only_shape_key, muted = state
+    obj.show_only_shape_key = show_only_shape_key
+    for block, mute in zip( obj.data.shape_keys.key_blocks, muted ):
+        block.mute = mute
+
 
 def obj_to_mesh( obj ):
     scene = bpy.context.scene
     
+    restore_active = scene.objects.active
+    restore_selected = [ item for item in scene.objects if item.select ]
+    
     mesh = obj.copy()
     mesh.data = obj.to_mesh( scene, True, 'PREVIEW' )
     
     scene.objects.link( mesh )
     scene.update()
-    bpy.ops.object.mode_set( mode = "OBJECT" )
+    # mode_set needs an active object, which may be missing in scene export.
+    if restore_active is not None:
+        bpy.ops.object.mode_set( mode = "OBJECT" )
     for item in scene.objects:
         item.select = False
 
@@ -696,12 +1424,26 @@ def obj_to_mesh( obj ):
     scene.update()
     bpy.ops.object.mode_set( mode = "OBJECT" )
 
+    triangulated = mesh.data
     mesh.data = mesh.to_mesh( scene, False, 'PREVIEW' )
+    bpy.data.meshes.remove( triangulated )
+    
+    mesh.select = False
+    for item in restore_selected:
+        item.select = True
+    scene.objects.active = restore_active
     scene.update()
 
     return mesh
 
 
+def remove_mesh( mesh ):
+    data = mesh.data
+    bpy.context.scene.objects.unlink( mesh )
+    bpy.data.objects.remove( mesh )
+    bpy.data.meshes.remove( data )
+
+
 def find_mesh_and_armature():
     context = bpy.context
     active_object = context.active_object
@@ -715,19 +1457,111 @@ def find_mesh_and_armature():
         raise Exception( "No mesh selected!" )
 
 
-def export( file_path ):
+def find_scene_meshes():
+    scene = bpy.context.scene
+    meshes = [ obj for obj in scene.objects if obj.type == 'MESH' and obj.is_visible( scene ) ]
+    
+    if not len( meshes ):
+        raise Exception( "No meshes in scene!" )
+    return meshes
+
+
+def export_scene( file_path, bounds = False, meshlets = False, morphs = False ):
+    
+    scene = bpy.context.scene
+    mops = MOPSFile()
+    mops.info.header.data_size = SIZE_INSTANCEINFO
+    
+    geometry_by_data = {}
+    geometry_by_hash = {}
+    
+    for obj in find_scene_meshes():
+        
+        # Modifiers and object-linked material slots may differ between linked
+        # duplicates, so only plain objects can reuse geometry by datablock alone.
+        data_key = obj.data.as_pointer()
+        if len( obj.modifiers ) or any( slot.link == 'OBJECT' for slot in obj.material_slots ):
+            data_key = None
+        
+        if data_key is not None and data_key in geometry_by_data:
+            geometry_index = geometry_by_data[ data_key ]
+        else:
+            if obj.parent and obj.parent.type == 'ARMATURE':
+                print( "Skinning of '{}' is not exported in scene mode".format( obj.name ) )
+            
+            part = MOPSFile()
+            shape_key_state = mute_shape_keys( obj ) if morphs else None
+            try:
+                mesh = obj_to_mesh( obj )
+            finally:
+                unmute_shape_keys( obj, shape_key_state )
+            
+            shape_keys = read_shape_keys( obj, mesh, Matrix() ) if morphs else None
+            parse_mesh( mesh, part, Matrix(), bounds, meshlets, shape_keys )
+            remove_mesh( mesh )
+            
+            digest = part.geometry_hash()
+            if digest in geometry_by_hash:
+                geometry_index = geometry_by_hash[ digest ]
+            else:
+                geometry_index = mops.append_geometry( part )
+                geometry_by_hash[ digest ] = geometry_index
+            
+            if data_key is not None:
+                geometry_by_data[ data_key ] = geometry_index
+        
+        position, orientation, scale = obj.matrix_world.decompose()
+        
+        instance = InstanceInfo( obj.name )
+        instance.geometry_index = geometry_index
+        
+        instance.position.x = position.x
+        instance.position.y = position.y
+        instance.position.z = position.z
+        
+        instance.orientation.x = -orientation.x
+        instance.orientation.y = -orientation.y
+        instance.orientation.z = -orientation.z
+        instance.orientation.w = orientation.w
+        
+        instance.scale.x = scale.x
+        instance.scale.y = scale.y
+        instance.scale.z = scale.z
+        
+        mops.add_info( instance )
+        print( "{} -> geometry {}".format( obj.name, geometry_index ) )
+    
+    print( "{} instances of {} geometries".format( len( mops.info.data ), len( mops.geometries.data ) ) )
+    
+    mops.print()
+    
+    file = open( file_path, "wb" )
+    file.write( mops.dump() )
+    file.close()
+
+
+def export( file_path, bounds = False, meshlets = False, morphs = False, morph_tracks = False ):
 
     mops = MOPSFile()
     
     active_object, armature = find_mesh_and_armature()
-    mesh = obj_to_mesh( active_object )
+    shape_key_state = mute_shape_keys( active_object ) if morphs else None
+    try:
+        mesh = obj_to_mesh( active_object )
+    finally:
+        unmute_shape_keys( active_object, shape_key_state )
     
     info = ObjectInfo( active_object.name )
     print( active_object.name )
     mops.add_info( info )
     
-    parse_mesh_and_armature( mesh, armature, mops )
-    bpy.context.scene.objects.unlink( mesh )
+    shape_keys = read_shape_keys( active_object, mesh, mesh.matrix_local ) if morphs else None
+    parse_mesh_and_armature( mesh, armature, mops, bounds, meshlets, shape_keys )
+    
+    if morphs and morph_tracks:
+        parse_morph_animations( active_object, armature, mops )
+    
+    remove_mesh( mesh )
     
     mops.print()
     